@@ -1,29 +1,101 @@
 import ast
+import io
+import threading
 from pathlib import Path
-from typing import List, Dict, Optional
-from tree_sitter_languages import get_parser
+from typing import List, Dict, Optional, Tuple
+from tree_sitter_languages import get_language, get_parser
+
+# 解析结果的版本号，代码块的提取逻辑或字段变化时递增，使 BlockCache 中的旧结果失效
+PARSER_VERSION = 1
+
+# tree-sitter Parser 不是线程安全的，每个线程按语言缓存一个实例复用
+_parsers = threading.local()
+
+
+def _get_cached_parser(language: str):
+    cache = getattr(_parsers, "by_language", None)
+    if cache is None:
+        cache = _parsers.by_language = {}
+    parser = cache.get(language)
+    if parser is None:
+        parser = cache[language] = get_parser(language)
+    return parser
+
+
+def _get_cached_query(language: str):
+    """按语言编译一次 函数/类 节点查询并缓存，不支持的语言返回 None"""
+    cache = getattr(_parsers, "queries", None)
+    if cache is None:
+        cache = _parsers.queries = {}
+    if language not in cache:
+        node_types = _BLOCK_NODE_TYPES.get(language)
+        query = None
+        if node_types:
+            try:
+                source = " ".join(f"({t}) @block" for t in sorted(node_types))
+                query = get_language(language).query(source)
+            except Exception as e:
+                print(f"编译查询失败 {language}: {e}")
+        cache[language] = query
+    return cache[language]
+
+
+# 定义不同语言的 函数/类 节点
+_BLOCK_NODE_TYPES = {
+    "java": frozenset({"class_declaration", "method_declaration"}),
+    "cpp": frozenset({"function_definition", "class_specifier"}),
+    "c": frozenset({"function_definition"}),
+    "javascript": frozenset({"function_declaration", "class_declaration", "method_definition"}),
+    "typescript": frozenset({"function_declaration", "class_declaration", "method_definition"}),
+    "go": frozenset({"function_declaration", "method_declaration", "type_declaration"}),  # type 可代表 struct
+}
+
+
+_PY_DEFINITION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+# 函数/类定义只会出现在这些节点的子节点中（match_case 为 Python 3.10+）
+_PY_STATEMENT_TYPES = (ast.stmt, ast.excepthandler) + ((ast.match_case,) if hasattr(ast, "match_case") else ())
 
 
 class SmartASTParser:
     """智能AST解析器，支持 Python / Java / C++ / JavaScript / TypeScript / Go 等语言"""
 
     @staticmethod
-    def extract_code_blocks(file_path: Path) -> List[Dict]:
-        try:
-            content = file_path.read_text(encoding="utf-8")
-        except Exception as e:
-            print(f"读取文件失败 {file_path}: {e}")
-            return []
+    def extract_code_blocks(file_path: Path, data: Optional[bytes] = None) -> List[Dict]:
+        """提取代码块；data 为调用方已读取的文件内容，为 None 时从磁盘读取"""
+        return SmartASTParser.extract_code_blocks_cacheable(file_path, data)[0]
 
+    @staticmethod
+    def extract_code_blocks_cacheable(file_path: Path, data: Optional[bytes] = None) -> Tuple[List[Dict], bool]:
+        """提取代码块，返回 (代码块, 结果是否可缓存)
+
+        读取文件、加载 parser 等与文件内容无关的失败是暂时的，结果不可缓存；
+        语法错误、编码错误等由文件内容决定的失败可以缓存。
+        """
         language = SmartASTParser._guess_language(file_path)
 
+        if data is None:
+            try:
+                data = file_path.read_bytes()
+            except Exception as e:
+                print(f"读取文件失败 {file_path}: {e}")
+                return [], False
+
         if language == "python":
+            try:
+                # 与 read_text 一致：按 UTF-8 解码并统一换行符
+                content = data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+            except Exception as e:
+                print(f"读取文件失败 {file_path}: {e}")
+                return [], True
             print(f"python 语言")
-            return SmartASTParser._extract_python(file_path, content)
+            return SmartASTParser._extract_python(file_path, content), True
         else:
-            # return []
+            # 其他语言由 tree-sitter 直接解析字节，无需解码整个文件
             print(f"其他语言： {language}")
-            return SmartASTParser._extract_other(file_path, content, language)
+            blocks = SmartASTParser._extract_other(file_path, data, language)
+            if blocks is None:
+                return [], False
+            return blocks, True
 
     # ---------------- 文件后缀 → 语言映射 ---------------- #
     @staticmethod
@@ -53,15 +125,42 @@ class SmartASTParser:
             print(f"语法错误在文件 {file_path}: {e}")
             return []
 
+        # 只切分一次文件，所有代码块共用（ast.get_source_segment 每次调用都会重新切分）
+        lines = io.StringIO(content, newline="").readlines()
+
         blocks: List[Dict] = []
-        for node in ast.walk(tree):
-            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
-                block_info = SmartASTParser._parse_python_node(node, content, file_path)
-                blocks.append(block_info)
+        for node in SmartASTParser._iter_python_definitions(tree.body):
+            block_info = SmartASTParser._parse_python_node(node, lines, file_path)
+            blocks.append(block_info)
         return blocks
 
     @staticmethod
-    def _parse_python_node(node, content: str, file_path: Path) -> Dict:
+    def _iter_python_definitions(nodes):
+        """只沿语句节点向下查找函数/类定义（含嵌套定义），不访问表达式等其他节点"""
+        for node in nodes:
+            if isinstance(node, _PY_DEFINITION_TYPES):
+                yield node
+            yield from SmartASTParser._iter_python_definitions(
+                child for child in ast.iter_child_nodes(node) if isinstance(child, _PY_STATEMENT_TYPES)
+            )
+
+    @staticmethod
+    def _source_segment(lines: List[str], node) -> str:
+        """与 ast.get_source_segment 结果一致，但复用预先切分好的行（列偏移是 UTF-8 字节偏移）"""
+        end_lineno = getattr(node, "end_lineno", None)
+        end_col_offset = getattr(node, "end_col_offset", None)
+        if end_lineno is None or end_col_offset is None:
+            return ""
+        lineno = node.lineno - 1
+        end_lineno -= 1
+        if lineno == end_lineno:
+            return lines[lineno].encode()[node.col_offset:end_col_offset].decode()
+        first = lines[lineno].encode()[node.col_offset:].decode()
+        last = lines[end_lineno].encode()[:end_col_offset].decode()
+        return first + "".join(lines[lineno + 1:end_lineno]) + last
+
+    @staticmethod
+    def _parse_python_node(node, lines: List[str], file_path: Path) -> Dict:
         block_type = "unknown"
         if isinstance(node, ast.FunctionDef):
             block_type = "function"
@@ -70,7 +169,7 @@ class SmartASTParser:
         elif isinstance(node, ast.ClassDef):
             block_type = "class"
 
-        block_code = ast.get_source_segment(content, node) or ""
+        block_code = SmartASTParser._source_segment(lines, node)
         
         # 生成唯一ID，包含行号和列号避免重复
         line_num = getattr(node, 'lineno', 0)
@@ -97,55 +196,61 @@ class SmartASTParser:
 
     # ---------------- 其他语言解析 ---------------- #
     @staticmethod
-    def _extract_other(file_path: Path, content: str, language: str) -> List[Dict]:
+    def _extract_other(file_path: Path, data: bytes, language: str) -> Optional[List[Dict]]:
+        """解析非 Python 文件；parser 加载或解析失败时返回 None"""
         try:
-            parser = get_parser(language)
+            parser = _get_cached_parser(language)
             if parser is None:
                 print(f"不支持的语言: {language} ({file_path})")
                 return []
         except Exception as e:
             print(f"加载 parser 失败 {language} ({file_path}): {e}")
-            return []
+            return None
 
         try:
-            tree = parser.parse(bytes(content, "utf8"))
+            tree = parser.parse(data)
         except Exception as e:
             print(f"解析失败 {file_path} ({language}): {e}")
-            return []
+            return None
 
         root = tree.root_node
         blocks: List[Dict] = []
-        SmartASTParser._walk(root, content, file_path, blocks, language)
+        query = _get_cached_query(language)
+        if query is None:
+            SmartASTParser._walk(root, data, file_path, blocks, language)
+            return blocks
+
+        # 由 tree-sitter 的查询引擎一次性匹配所有 函数/类 节点
+        for node, _ in query.captures(root):
+            blocks.append(SmartASTParser._parse_other_node(node, data, file_path))
         return blocks
 
     @staticmethod
-    def _walk(node, content: str, file_path: Path, blocks: List[Dict], language: str):
-        node_type = node.type
-
-        # 定义不同语言的 函数/类 节点
-        lang_nodes = {
-            "java": ["class_declaration", "method_declaration"],
-            "cpp": ["function_definition", "class_specifier"],
-            "c": ["function_definition"],
-            "javascript": ["function_declaration", "class_declaration", "method_definition"],
-            "typescript": ["function_declaration", "class_declaration", "method_definition"],
-            "go": ["function_declaration", "method_declaration", "type_declaration"],  # type 可代表 struct
-        }
-
-        if language in lang_nodes and node_type in lang_nodes[language]:
-            blocks.append(SmartASTParser._parse_other_node(node, content, file_path))
+    def _walk(node, data: bytes, file_path: Path, blocks: List[Dict], language: str):
+        targets = _BLOCK_NODE_TYPES.get(language)
+        if not targets:
+            return
 
-        for child in node.children:
-            SmartASTParser._walk(child, content, file_path, blocks, language)
+        # 用 TreeCursor 做先序遍历，避免逐节点递归和访问 .children 的开销
+        cursor = node.walk()
+        while True:
+            if cursor.node.type in targets:
+                blocks.append(SmartASTParser._parse_other_node(cursor.node, data, file_path))
+            if cursor.goto_first_child():
+                continue
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return
 
     @staticmethod
-    def _parse_other_node(node, content: str, file_path: Path) -> Dict:
+    def _parse_other_node(node, data: bytes, file_path: Path) -> Dict:
         start_line, end_line = node.start_point[0] + 1, node.end_point[0] + 1
         start_col = node.start_point[1]
-        code_segment = content[node.start_byte:node.end_byte]
+        # start_byte/end_byte 是字节偏移，只解码需要的片段
+        code_segment = data[node.start_byte:node.end_byte].decode("utf-8", errors="replace")
 
         # 生成唯一ID，包含行列信息
-        name = SmartASTParser._extract_name(node, content) or node.type
+        name = SmartASTParser._extract_name(node, data) or node.type
         
         return {
             "id": f"{file_path}:{name}:{start_line}:{start_col}",
@@ -159,10 +264,10 @@ class SmartASTParser:
         }
 
     @staticmethod
-    def _extract_name(node, content: str) -> Optional[str]:
+    def _extract_name(node, data: bytes) -> Optional[str]:
         """提取函数/类名（依赖 identifier 节点）"""
         for child in node.children:
             if child.type == "identifier":
-                return content[child.start_byte:child.end_byte]
+                return data[child.start_byte:child.end_byte].decode("utf-8", errors="replace")
         return None
 
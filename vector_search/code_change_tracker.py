@@ -1,44 +1,130 @@
 import hashlib
 import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Any
-from dataclasses import dataclass
 
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖，没有安装时退回标准库 json
+    orjson = None
 
-@dataclass
-class MerkleNode:
-    """Merkle树节点"""
-    hash: str
-    left: Optional['MerkleNode'] = None
-    right: Optional['MerkleNode'] = None
-    file_path: Optional[str] = None
-    is_leaf: bool = False
+# 小文件一次性读入内存即可，大文件流式求哈希
+_SMALL_FILE_SIZE = 64 * 1024
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_SOURCE_EXTS = {".py", ".java", ".cpp", ".cc", ".cxx", ".c", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go"}
+_ROOT_HASH_PREFIX = re.compile(rb'\{\s*"root_hash"\s*:\s*(?:null|"([0-9a-f]*)")')
+_IGNORE_PATTERNS = ('__pycache__', '.pytest_cache', '.venv', 'env', 'venv', 'node_modules', '.git', '.idea', '.vscode')
+
+
+def _iter_source_files(root: Path):
+    """遍历项目下所有源码文件，在目录层面剪掉忽略的目录，不再进入其中"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        # 目录名命中忽略规则时，其下所有文件都会被 _should_index_file 排除
+        dirnames[:] = [d for d in dirnames if not any(p in d for p in _IGNORE_PATTERNS)]
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in _SOURCE_EXTS:
+                yield Path(dirpath, filename)
+
+
+def _read_json(path: Path) -> Any:
+    """读取 JSON 文件，优先使用 orjson"""
+    data = path.read_bytes()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _write_json(path: Path, obj: Any):
+    """以紧凑格式写入 JSON 文件，优先使用 orjson"""
+    if orjson:
+        path.write_bytes(orjson.dumps(obj))
+    else:
+        path.write_text(json.dumps(obj, separators=(',', ':')))
+
+
+def _compute_file_hash(file_path: Path) -> str:
+    """计算文件哈希（直接对原始字节求哈希，避免解码/重新编码）"""
+    try:
+        if file_path.stat().st_size < _SMALL_FILE_SIZE:
+            return hashlib.sha256(file_path.read_bytes()).hexdigest()
+        with open(file_path, 'rb') as f:
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, 'sha256').hexdigest()
+            # Python < 3.11 没有 file_digest，分块读取
+            h = hashlib.sha256()
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+            return h.hexdigest()
+    except Exception as e:
+        print(f"计算文件哈希失败 {file_path}: {e}")
+        return ""
+
+
+class IncrementalMerkle:
+    """增量Merkle树
+
+    只保存 popcount(count) 个完全子树的根哈希（frontier），追加一个叶子是 O(log n)，
+    不再为每个节点分配对象。叶子需按文件路径排序后依次追加，根哈希与逐层构建
+    （奇数个节点时复制最后一个节点）的结果一致。
+
+    leaves 只是对 文件路径 -> 文件哈希 字典的引用，用于持久化，不参与计算。
+    """
+
+    __slots__ = ('count', 'frontier', 'leaves')
+
+    def __init__(self, count: int = 0, frontier: Optional[List[str]] = None,
+                 leaves: Optional[Dict[str, str]] = None):
+        self.count = count
+        self.frontier: List[str] = frontier if frontier is not None else []
+        self.leaves: Dict[str, str] = leaves if leaves is not None else {}
+
+    def append(self, file_hash: str):
+        """追加一个叶子，合并同高度的子树"""
+        node = file_hash
+        n = self.count
+        # count 的每个低位 1 对应 frontier 末尾一个同高度的子树
+        while n & 1:
+            node = CodeChangeTracker._hash_pair(self.frontier.pop(), node)
+            n >>= 1
+        self.frontier.append(node)
+        self.count += 1
+
+    def root(self) -> Optional[str]:
+        """从低到高折叠 frontier 得到根哈希"""
+        if not self.frontier:
+            return None
+        heights = [h for h in range(self.count.bit_length() - 1, -1, -1) if self.count >> h & 1]
+        node, height = self.frontier[-1], heights[-1]
+        for peak, peak_height in zip(reversed(self.frontier[:-1]), reversed(heights[:-1])):
+            # 奇数个节点，复制最后一个节点直到与左侧子树等高
+            while height < peak_height:
+                node = CodeChangeTracker._hash_pair(node, node)
+                height += 1
+            node = CodeChangeTracker._hash_pair(peak, node)
+            height += 1
+        return node
 
     def to_dict(self) -> Dict[str, Any]:
         """序列化为字典"""
         return {
-            'hash': self.hash,
-            'left': self.left.to_dict() if self.left else None,
-            'right': self.right.to_dict() if self.right else None,
-            'file_path': self.file_path,
-            'is_leaf': self.is_leaf
+            'count': self.count,
+            'frontier': list(self.frontier),
+            # 扁平的 [[path, hash], ...] 数组，按路径排序
+            'leaves': sorted(self.leaves.items())
         }
 
     @classmethod
-    def from_dict(cls, data: Dict[str, Any]) -> 'MerkleNode':
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> Optional['IncrementalMerkle']:
         """从字典反序列化"""
-        if data is None:
+        if not data or 'leaves' not in data:
             return None
-        node = cls(
-            hash=data['hash'],
-            file_path=data.get('file_path'),
-            is_leaf=data.get('is_leaf', False)
+        return cls(
+            count=data.get('count', 0),
+            frontier=data.get('frontier', []),
+            leaves=data['leaves']
         )
-        if data.get('left'):
-            node.left = cls.from_dict(data['left'])
-        if data.get('right'):
-            node.right = cls.from_dict(data['right'])
-        return node
 
 
 class CodeChangeTracker:
@@ -69,95 +155,96 @@ class CodeChangeTracker:
         return hashlib.sha256(combined.encode()).hexdigest()
 
     @staticmethod
-    def _build_merkle_tree(file_hashes: Dict[str, str]) -> Optional[MerkleNode]:
+    def _build_merkle_tree(file_hashes: Dict[str, str]) -> Optional[IncrementalMerkle]:
         """构建Merkle树"""
         if not file_hashes:
             return None
 
-        # 按文件路径排序确保一致性
-        sorted_files = sorted(file_hashes.items())
-        
-        # 创建叶子节点
-        leaves = []
-        for file_path, file_hash in sorted_files:
-            leaf = MerkleNode(
-                hash=file_hash,
-                file_path=file_path,
-                is_leaf=True
-            )
-            leaves.append(leaf)
-
-        # 如果只有一个文件，直接返回
-        if len(leaves) == 1:
-            return leaves[0]
-
-        # 构建树
-        current_level = leaves
-        while len(current_level) > 1:
-            next_level = []
-            
-            # 处理成对节点
-            for i in range(0, len(current_level), 2):
-                left = current_level[i]
-                right = current_level[i + 1] if i + 1 < len(current_level) else None
-                
-                if right is None:
-                    # 奇数个节点，复制最后一个节点
-                    right = left
-                
-                # 计算父节点哈希
-                parent_hash = CodeChangeTracker._hash_pair(left.hash, right.hash)
-                parent = MerkleNode(
-                    hash=parent_hash,
-                    left=left,
-                    right=right
-                )
-                next_level.append(parent)
-            
-            current_level = next_level
-
-        return current_level[0] if current_level else None
+        # 按文件路径排序确保一致性；叶子哈希逐个流入 frontier，不复制字典
+        tree = IncrementalMerkle(leaves=file_hashes)
+        for file_path in sorted(file_hashes):
+            tree.append(file_hashes[file_path])
+        return tree
 
     @staticmethod
-    def load_merkle_tree(project_root: str, index_dir: str = ".code_index") -> Optional[MerkleNode]:
-        """加载Merkle树"""
+    def _load_merkle_data(project_root: str, index_dir: str = ".code_index") -> Dict[str, Any]:
+        """读取 merkle_tree.json 的内容，leaves 转换为 文件路径 -> 文件哈希 字典"""
         merkle_file = CodeChangeTracker._get_merkle_tree_file(project_root, index_dir)
         if merkle_file.exists():
             try:
-                with open(merkle_file, 'r') as f:
-                    tree_data = json.load(f)
-                    return CodeChangeTracker._deserialize_merkle_tree(tree_data.get('tree'))
+                data = _read_json(merkle_file)
+                if isinstance(data.get('leaves'), list):
+                    data['leaves'] = dict(data['leaves'])
+                elif 'leaves' not in data and data.get('tree'):
+                    # 旧格式只保存嵌套的 MerkleNode 树，从叶子节点还原 文件路径 -> 文件哈希
+                    data['leaves'] = CodeChangeTracker._legacy_tree_leaves(data['tree'])
+                return data
             except Exception as e:
                 print(f"加载Merkle树失败: {e}")
-                return None
-        return None
+        return {}
+
+    @staticmethod
+    def _legacy_tree_leaves(tree: Dict[str, Any]) -> Dict[str, str]:
+        """遍历旧格式的嵌套树，收集叶子节点（奇数节点被复制的叶子会重复出现，字典自然去重）"""
+        leaves = {}
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node.get('is_leaf'):
+                leaves[node['file_path']] = node['hash']
+                continue
+            stack.extend(child for child in (node.get('left'), node.get('right')) if child)
+        return leaves
+
+    @staticmethod
+    def load_merkle_tree(project_root: str, index_dir: str = ".code_index") -> Optional[IncrementalMerkle]:
+        """加载Merkle树"""
+        data = CodeChangeTracker._load_merkle_data(project_root, index_dir)
+        if 'frontier' not in data and data.get('leaves'):
+            # 旧格式没有 frontier，由叶子重建
+            return CodeChangeTracker._build_merkle_tree(data['leaves'])
+        return IncrementalMerkle.from_dict(data)
+
+    @staticmethod
+    def load_leaves(project_root: str, index_dir: str = ".code_index") -> Dict[str, str]:
+        """只加载叶子（文件路径 -> 文件哈希），不重建Merkle树"""
+        return CodeChangeTracker._load_merkle_data(project_root, index_dir).get('leaves') or {}
 
     @staticmethod
-    def save_merkle_tree(project_root: str, root: Optional[MerkleNode], index_dir: str = ".code_index"):
+    def save_merkle_tree(project_root: str, tree: Optional[IncrementalMerkle], index_dir: str = ".code_index"):
         """保存Merkle树"""
         from datetime import datetime
         merkle_file = CodeChangeTracker._get_merkle_tree_file(project_root, index_dir)
+        root_hash = tree.root() if tree else None
+        # 根哈希未变时不重写文件
+        if merkle_file.exists() and CodeChangeTracker.get_merkle_root_hash(project_root, index_dir) == root_hash:
+            return
         tree_data = {
-            'root_hash': root.hash if root else None,
-            'tree': CodeChangeTracker._serialize_merkle_tree(root),
+            'root_hash': root_hash,
+            **(tree or IncrementalMerkle()).to_dict(),
             'timestamp': datetime.now().isoformat()
         }
-        with open(merkle_file, 'w') as f:
-            json.dump(tree_data, f, indent=2)
+        _write_json(merkle_file, tree_data)
 
     @staticmethod
     def get_merkle_root_hash(project_root: str, index_dir: str = ".code_index") -> Optional[str]:
-        """获取Merkle根哈希"""
-        tree = CodeChangeTracker.load_merkle_tree(project_root, index_dir)
-        return tree.hash if tree else None
+        """获取Merkle根哈希（root_hash 是文件中的第一个字段，只读取文件开头）"""
+        merkle_file = CodeChangeTracker._get_merkle_tree_file(project_root, index_dir)
+        try:
+            with open(merkle_file, 'rb') as f:
+                match = _ROOT_HASH_PREFIX.match(f.read(128))
+            if match:
+                return match.group(1).decode() if match.group(1) is not None else None
+        except OSError:
+            return None
+        return CodeChangeTracker._load_merkle_data(project_root, index_dir).get('root_hash')
 
     @staticmethod
     def load_metadata(project_root: str, index_dir: str = ".code_index") -> dict:
         """加载元数据"""
         metadata_file = CodeChangeTracker._get_metadata_file(project_root, index_dir)
         if metadata_file.exists():
-            with open(metadata_file, 'r') as f:
-                metadata = json.load(f)
+            metadata = _read_json(metadata_file)
         else:
             metadata = {
                 'last_index_time': None,
@@ -171,49 +258,59 @@ class CodeChangeTracker:
     def save_metadata(project_root: str, metadata: dict, index_dir: str = ".code_index"):
         """保存元数据"""
         metadata_file = CodeChangeTracker._get_metadata_file(project_root, index_dir)
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        _write_json(metadata_file, metadata)
 
     @staticmethod
     def compute_file_hash(file_path: Path) -> str:
         """计算文件哈希"""
-        try:
-            content = file_path.read_text(encoding='utf-8')
-            return hashlib.sha256(content.encode()).hexdigest()
-        except Exception as e:
-            print(f"计算文件哈希失败 {file_path}: {e}")
-            return ""
+        return _compute_file_hash(file_path)
+
+    @staticmethod
+    def compute_bytes_hash(data: bytes) -> str:
+        """计算已读入内存的文件内容的哈希，与 compute_file_hash 结果一致"""
+        return hashlib.sha256(data).hexdigest()
 
     @staticmethod
     def _collect_file_hashes(project_root: str) -> Dict[str, str]:
         """收集所有文件的哈希值"""
         # 这个是最新的所有文件的哈希
         project_path = Path(project_root)
+        rel_paths = []
+        paths = []
+        for file_path in _iter_source_files(project_path):
+            if CodeChangeTracker._should_index_file(file_path):
+                rel_paths.append(str(file_path.relative_to(project_path)))
+                paths.append(file_path)
+
+        # 读文件和 sha256 都会释放 GIL，用线程池并行计算哈希
         file_hashes = {}
-        EXTS = {".py", ".java", ".cpp", ".cc", ".cxx", ".c", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go"}
-        for file_path in project_path.rglob('*'):
-            if file_path.suffix.lower() in EXTS:
-                if CodeChangeTracker._should_index_file(file_path):
-                    rel_path = str(file_path.relative_to(project_path))
-                    file_hash = CodeChangeTracker.compute_file_hash(file_path)
-                    file_hashes[rel_path] = file_hash
-        
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            for rel_path, file_hash in zip(rel_paths, ex.map(_compute_file_hash, paths)):
+                file_hashes[rel_path] = file_hash
+
         return file_hashes
 
     @staticmethod
-    def detect_changes(project_root: str, index_dir: str = ".code_index") -> Dict[str, List[str]]:
-        """使用Merkle树检测代码变更"""
+    def detect_changes(project_root: str, index_dir: str = ".code_index",
+                       file_hashes: Optional[Dict[str, str]] = None) -> Dict[str, List[str]]:
+        """使用Merkle树检测代码变更
+
+        file_hashes: 调用方已经收集好的当前文件哈希，为 None 时内部实时计算
+        """
         # project_path = Path(project_root)
         
         # 获取当前所有文件哈希（最新的），需要实时计算
-        current_file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        if file_hashes is None:
+            file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        current_file_hashes = file_hashes
         
-        # 获取旧的Merkle根哈希
-        old_root_hash = CodeChangeTracker.get_merkle_root_hash(project_root, index_dir)
+        # 获取旧的Merkle根哈希和叶子，只读一次文件
+        old_data = CodeChangeTracker._load_merkle_data(project_root, index_dir)
+        old_root_hash = old_data.get('root_hash')
         
         # 构建新的Merkle树
         new_tree = CodeChangeTracker._build_merkle_tree(current_file_hashes)
-        new_root_hash = new_tree.hash if new_tree else None
+        new_root_hash = new_tree.root() if new_tree else None
         
         changes = {'added': [], 'modified': [], 'deleted': [], 'unchanged': []}
         
@@ -223,13 +320,8 @@ class CodeChangeTracker:
             changes['unchanged'] = list(current_file_hashes.keys())
             return changes
         
-        # 根哈希不同，需要详细检测变更
-        old_tree = CodeChangeTracker.load_merkle_tree(project_root, index_dir)
-        
-        # 从旧树中提取文件哈希（如果存在）
-        old_file_hashes = {}
-        if old_tree:
-            old_file_hashes = CodeChangeTracker._extract_file_hashes_from_tree(old_tree)
+        # 根哈希不同，需要详细检测变更；旧树中保存了叶子，直接比较文件哈希
+        old_file_hashes = old_data.get('leaves') or {}
         
         # 检测变更
         current_files = set(current_file_hashes.keys())
@@ -247,77 +339,15 @@ class CodeChangeTracker:
                 changes['unchanged'].append(file_path)
         
         # 保存新的Merkle树
-        new_tree = CodeChangeTracker._build_merkle_tree(current_file_hashes)
         CodeChangeTracker.save_merkle_tree(project_root, new_tree, index_dir)
         
         return changes
 
-    @staticmethod
-    def _extract_file_hashes_from_tree(root: MerkleNode) -> Dict[str, str]:
-        """从Merkle树中提取文件哈希"""
-        # 这个应该是旧的记录
-        file_hashes = {}
-        
-        def traverse(node: MerkleNode):
-            if node.is_leaf and node.file_path:
-                file_hashes[node.file_path] = node.hash
-            if node.left:
-                traverse(node.left)
-            if node.right:
-                traverse(node.right)
-        
-        if root:
-            traverse(root)
-        return file_hashes
-
-    @staticmethod
-    def _serialize_merkle_tree(root: Optional[MerkleNode]) -> Optional[Dict]:
-        """序列化Merkle树为字典"""
-        if not root:
-            return None
-        
-        def serialize_node(node: MerkleNode) -> Dict:
-            return {
-                'hash': node.hash,
-                'file_path': node.file_path,
-                'is_leaf': node.is_leaf,
-                'left': serialize_node(node.left) if node.left else None,
-                'right': serialize_node(node.right) if node.right else None
-            }
-        
-        return serialize_node(root)
-
-    @staticmethod
-    def _deserialize_merkle_tree(data: Optional[Dict]) -> Optional[MerkleNode]:
-        """从字典反序列化Merkle树"""
-        if not data:
-            return None
-        
-        def deserialize_node(node_data: Dict) -> Optional[MerkleNode]:
-            if not node_data:
-                return None
-            
-            node = MerkleNode(
-                hash=node_data['hash'],
-                file_path=node_data['file_path'],
-                is_leaf=node_data['is_leaf']
-            )
-            
-            if node_data.get('left'):
-                node.left = deserialize_node(node_data['left'])
-            if node_data.get('right'):
-                node.right = deserialize_node(node_data['right'])
-            
-            return node
-        
-        return deserialize_node(data)
-
     @staticmethod
     def _should_index_file(file_path: Path) -> bool:
         """判断是否应该索引文件"""
-        ignore_patterns = ['__pycache__', '.pytest_cache', '.venv', 'env', 'venv', 'node_modules', '.git', '.idea', '.vscode']
         s = str(file_path)
-        if any(p in s for p in ignore_patterns):
+        if any(p in s for p in _IGNORE_PATTERNS):
             return False
         # skip test files by naming
         if file_path.name.startswith('test_') or file_path.name.endswith('_test.py'):
@@ -325,9 +355,12 @@ class CodeChangeTracker:
         return True
 
     @staticmethod
-    def update_file_hashes(project_root: str, file_paths: List[str], hashes: List[str], index_dir: str = ".code_index"):
+    def update_file_hashes(project_root: str, file_paths: List[str], hashes: List[str], index_dir: str = ".code_index",
+                           file_hashes: Optional[Dict[str, str]] = None):
         """更新文件哈希并重建Merkle树"""
-        current_file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        if file_hashes is None:
+            file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        current_file_hashes = dict(file_hashes)
         for rel, h in zip(file_paths, hashes):
             current_file_hashes[rel] = h
         # 虽然这个字典只更新其中部分内容，但是重建树用的是一整个字典
@@ -335,9 +368,12 @@ class CodeChangeTracker:
         CodeChangeTracker.save_merkle_tree(project_root, new_tree, index_dir)
 
     @staticmethod
-    def remove_file_hash(project_root: str, file_paths: List[str], index_dir: str = ".code_index"):
+    def remove_file_hash(project_root: str, file_paths: List[str], index_dir: str = ".code_index",
+                         file_hashes: Optional[Dict[str, str]] = None):
         """移除文件哈希并重建Merkle树"""
-        current_file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        if file_hashes is None:
+            file_hashes = CodeChangeTracker._collect_file_hashes(project_root)
+        current_file_hashes = dict(file_hashes)
         for rel in file_paths:
             current_file_hashes.pop(rel, None)
         new_tree = CodeChangeTracker._build_merkle_tree(current_file_hashes)
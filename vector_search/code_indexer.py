@@ -1,14 +1,33 @@
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict
-from hashlib import md5
+from functools import lru_cache
+from typing import Iterator, List, Dict, Optional, Tuple
+from hashlib import blake2b, md5
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from openai import OpenAI
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from .vector_db import VectorDBManager
 from .ast_parser import SmartASTParser
 from .code_change_tracker import CodeChangeTracker
+from .index_cache import BlockCache, EmbeddingCache
+
+@lru_cache(maxsize=64)
+def _collection_name_for(project_path: str) -> str:
+    """项目路径 -> 向量库集合名，索引器与 query 工具共用；缓存结果，避免重复 resolve 路径和计算哈希"""
+    project_root = Path(project_path)
+    proj_hash = blake2b(str(project_root.resolve()).encode(), digest_size=4).hexdigest()
+    return f"{project_root.name}-{proj_hash}"
+
+
+@lru_cache(maxsize=64)
+def _legacy_collection_name_for(project_path: str) -> str:
+    """旧版本使用的集合名（md5 前 8 位），用于兼容此前已建立的索引"""
+    project_root = Path(project_path)
+    proj_hash = md5(str(project_root.resolve()).encode()).hexdigest()[:8]
+    return f"{project_root.name}-{proj_hash}"
+
 
 class IncrementalCodeIndexer:
     """增量代码索引系统
@@ -22,11 +41,28 @@ class IncrementalCodeIndexer:
         self.parser = SmartASTParser()
         self.vector_db = vector_db_manager
         self.embedding_client = embedding_client
+        self.embedding_model = "jina"
+        # 超过 MAX_LENGTH 的文本块按 CHUNK_SIZE 切分，切分器只创建一次
+        self.max_length = int(os.environ.get("MAX_LENGTH", 8000))
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=int(os.environ.get("CHUNK_SIZE", 4000)),
+            chunk_overlap=int(os.environ.get("CHUNK_OVERLAP", 200)),
+            length_function=len,
+            separators=["\n\n", "\n", " ", ""]
+        )
 
-    def run_incremental_indexing(self, project_root_str: str):
-        """执行增量索引"""
+    def _get_collection_name(self, project_root_str: str) -> str:
+        """获取项目对应的向量库集合名；旧版本建立的集合仍存在且尚无新集合时沿用旧集合"""
+        return self.vector_db.resolve_collection_name(
+            _collection_name_for(project_root_str), _legacy_collection_name_for(project_root_str)
+        )
+
+    def run_incremental_indexing(self, project_root_str: str) -> Dict[str, List[str]]:
+        """执行增量索引，返回检测到的变更"""
         print("🔍 检测代码变更...")
-        changes = CodeChangeTracker.detect_changes(project_root_str)
+        # 本次索引只遍历、哈希一次项目文件，后续步骤复用
+        file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
+        changes = CodeChangeTracker.detect_changes(project_root_str, file_hashes=file_hashes)
 
         print(f"📊 变更统计:")
         print(f"新增文件: {len(changes['added'])}")
@@ -34,43 +70,39 @@ class IncrementalCodeIndexer:
         print(f"删除文件: {len(changes['deleted'])}")
         print(f"未变更文件: {len(changes['unchanged'])}")
 
-        project_root = Path(project_root_str)
-        proj_name = project_root.name
-        proj_hash = md5(str(project_root.resolve()).encode()).hexdigest()[:8]
-        collection_name = f"{proj_name}-{proj_hash}"
+        collection_name = self._get_collection_name(project_root_str)
 
         # 处理删除的文件
         if changes['deleted']:
             print("🗑️  处理删除的文件...")
             for file_path in changes['deleted']:
                 self.vector_db.delete_blocks_by_file(collection_name, file_path)
-            CodeChangeTracker.remove_file_hash(project_root_str, changes['deleted'])
+            CodeChangeTracker.remove_file_hash(project_root_str, changes['deleted'], file_hashes=file_hashes)
+            with BlockCache(project_root_str) as block_cache:
+                block_cache.remove(changes['deleted'])
 
         # 处理新增和修改的文件
         files_to_process = changes['added'] + changes['modified']
         if files_to_process:
             print(f"🔄 处理 {len(files_to_process)} 个文件...")
-            self._process_files(project_root_str, files_to_process)
+            self._process_files(project_root_str, files_to_process, file_hashes)
+
+        self.vector_db.flush()
 
         # 更新元数据
         metadata = CodeChangeTracker.load_metadata(project_root_str)
         metadata['last_index_time'] = datetime.now().isoformat()
-        file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
         metadata['total_files_indexed'] = len(file_hashes)
         CodeChangeTracker.save_metadata(project_root_str, metadata)
 
         print("✅ 增量索引完成！")
+        return changes
 
     def full_index(self, project_root_str: str):
         """执行完整索引：扫描所有可索引的 .py 文件并作为新增处理"""
-        all_py_files = []
-        EXTS = {".py", ".java", ".cpp", ".cc", ".cxx", ".c", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go"}
-        project_path = Path(project_root_str)
-        for file_path in project_path.rglob('*'):
-            if file_path.suffix.lower() in EXTS:
-                if CodeChangeTracker._should_index_file(file_path):
-                    rel_path = str(file_path.relative_to(project_path))
-                    all_py_files.append(rel_path)
+        # 可索引文件与 _collect_file_hashes 的筛选规则一致，直接复用其结果
+        file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
+        all_py_files = list(file_hashes)
 
         if not all_py_files:
             print("No python files found to index.")
@@ -78,41 +110,56 @@ class IncrementalCodeIndexer:
 
         # treat everything as added for first-time index
         print(f"🔁 全量索引：发现 {len(all_py_files)} 个文件，开始处理...")
-        self._process_files(project_root_str, all_py_files)
+        self._process_files(project_root_str, all_py_files, file_hashes, prune_embed_cache=True)
+        self.vector_db.flush()
         # update metadata
         metadata = CodeChangeTracker.load_metadata(project_root_str)
         metadata['last_index_time'] = datetime.now().isoformat()
-        file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
         metadata['total_files_indexed'] = len(file_hashes)
         CodeChangeTracker.save_metadata(project_root_str, metadata)
 
-    def _process_files(self, project_root_str:str, file_paths: List[str]):
-        """处理文件列表"""
+    def _process_files(self, project_root_str:str, file_paths: List[str], file_hashes: Optional[Dict[str, str]] = None,
+                       prune_embed_cache: bool = False):
+        """处理文件列表
+
+        file_hashes: 本次索引已收集的当前文件哈希，为 None 时内部实时计算
+        prune_embed_cache: 为 True 时（全量索引），处理完成后从嵌入缓存中删除本次未用到的向量
+        """
         new_hashes = []
         all_blocks = []
+        all_processed_texts = []
 
-        project_root = Path(project_root_str)
-        proj_name = project_root.name
-        proj_hash = md5(str(project_root.resolve()).encode()).hexdigest()[:8]
-        collection_name = f"{proj_name}-{proj_hash}"
+        collection_name = self._get_collection_name(project_root_str)
 
-        file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
-        for rel_path in file_paths:
-            file_path = Path(project_root_str) / rel_path
+        if file_hashes is None:
+            file_hashes = CodeChangeTracker._collect_file_hashes(project_root_str)
+        with BlockCache(project_root_str) as block_cache:
+            for rel_path in file_paths:
+                file_path = Path(project_root_str) / rel_path
 
-            # 删除旧索引（对于修改的文件）
-            if rel_path in file_hashes:
-                self.vector_db.delete_blocks_by_file(collection_name, str(file_path))
+                # 删除旧索引（对于修改的文件）
+                if rel_path in file_hashes:
+                    self.vector_db.delete_blocks_by_file(collection_name, str(file_path))
 
-            # 解析新代码块
-            blocks = self.parser.extract_code_blocks(file_path)
-            all_blocks.extend(blocks)
+                # 只读一次文件，计算哈希和解析共用同一份内容
+                try:
+                    data = file_path.read_bytes()
+                    file_hash = CodeChangeTracker.compute_bytes_hash(data)
+                except Exception as e:
+                    print(f"读取文件失败 {file_path}: {e}")
+                    data, file_hash = None, ""
+                new_hashes.append((rel_path, file_hash))
 
-            # 计算文件哈希
-            file_hash = CodeChangeTracker.compute_file_hash(file_path)
-            new_hashes.append((rel_path, file_hash))
+                # 解析新代码块，文件内容未变时直接使用缓存的解析结果
+                blocks = block_cache.get(rel_path, file_hash, file_path) if data is not None else []
+                if blocks is None:
+                    blocks, cacheable = self.parser.extract_code_blocks_cacheable(file_path, data)
+                    # 加载 parser 失败等暂时性错误不缓存，下次索引时重新解析
+                    if cacheable:
+                        block_cache.put(rel_path, file_hash, blocks, file_path)
+                all_blocks.extend(blocks)
 
-            print(f"  处理 {rel_path}: 找到 {len(blocks)} 个代码块")
+                print(f"  处理 {rel_path}: 找到 {len(blocks)} 个代码块")
 
         # 生成嵌入向量
         if all_blocks:
@@ -120,25 +167,16 @@ class IncrementalCodeIndexer:
             
             # 处理长文本块的切分
             all_processed_blocks = []
-            all_processed_texts = []
             
             for block in all_blocks:
                 text = self._prepare_text_for_embedding(block)
                 
                 # 检查是否需要切分
-                max_length = os.environ.get("MAX_LENGTH", 8000)
-                if len(text) <= max_length:
+                if len(text) <= self.max_length:
                     all_processed_blocks.append(block)
                     all_processed_texts.append(text)
                 else:
-                        
-                    text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=int(os.environ.get("CHUNK_SIZE", 4000)),
-                        chunk_overlap=int(os.environ.get("CHUNK_OVERLAP", 200)),
-                        length_function=len,
-                        separators=["\n\n", "\n", " ", ""]
-                    )
-                    chunks = text_splitter.split_text(text)
+                    chunks = self.text_splitter.split_text(text)
                     
                     # 为每个chunk创建新的block
                     for i, chunk in enumerate(chunks):
@@ -153,29 +191,120 @@ class IncrementalCodeIndexer:
 
             print(f"处理后的文本块: {len(all_processed_texts)}")
             
-            embeddings = []
-            valid_blocks = []
-            
-            for i, (text, block) in enumerate(zip(all_processed_texts, all_processed_blocks)):
-                try:
-                    response = self.embedding_client.embeddings.create(input=[text], model="jina")
-                    embeddings.append(response.data[0].embedding)
-                    valid_blocks.append(block)
-                except Exception as e:
-                    print(f"处理文本块 {i} 时出错: {e}")
-                    print(f"文本长度: {len(text)}")
-                    continue
-            
-            # 更新向量数据库
+            # 嵌入与写入流水线化：每批嵌入返回后立即推送给后台写入线程，不等待全部嵌入完成
             print("💾 更新向量数据库...")
-            if embeddings and valid_blocks:
-                self.vector_db.upsert_blocks(collection_name, valid_blocks, embeddings)
-            else:
+            upsert_queue, upsert_worker = self.vector_db.start_upsert_worker(collection_name)
+            upserted = 0
+            try:
+                with EmbeddingCache(project_root_str) as embed_cache:
+                    for valid_blocks, embeddings in self._iter_embeddings(
+                            all_processed_texts, all_processed_blocks, embed_cache):
+                        self.vector_db.upsert_blocks_streaming(upsert_queue, valid_blocks, embeddings)
+                        upserted += len(valid_blocks)
+            finally:
+                self.vector_db.finish_upsert_worker(upsert_queue, upsert_worker)
+            if not upserted:
                 print("⚠️  没有有效的嵌入向量或代码块需要更新")
 
+        if prune_embed_cache:
+            # 全量索引覆盖了项目中的所有代码块，未被引用的向量对应已修改或删除的代码，不再需要
+            keep_hashes = {EmbeddingCache.text_hash(self.embedding_model, t) for t in all_processed_texts}
+            with EmbeddingCache(project_root_str) as embed_cache:
+                removed = embed_cache.prune(keep_hashes)
+            if removed:
+                print(f"🧹 清理嵌入缓存: 删除 {removed} 条未使用的向量")
+
         # 更新文件哈希记录
         file_paths, hashes = zip(*new_hashes) if new_hashes else ([], [])
-        CodeChangeTracker.update_file_hashes(project_root_str, list(file_paths), list(hashes))
+        CodeChangeTracker.update_file_hashes(project_root_str, list(file_paths), list(hashes), file_hashes=file_hashes)
+
+    def _iter_embeddings(self, texts: List[str], blocks: List[Dict], embed_cache: EmbeddingCache,
+                         chunk_size: int = 256) -> Iterator[Tuple[List[Dict], List[List[float]]]]:
+        """按批次生成嵌入向量，逐批产出 (有效代码块, 对应的 embeddings)
+
+        内容相同的文本只请求一次，已缓存的向量最先产出；其余批次按嵌入请求完成的先后产出。
+        """
+        text_hashes = [EmbeddingCache.text_hash(self.embedding_model, t) for t in texts]
+        # 文本哈希 -> 使用该文本的代码块下标
+        blocks_by_hash: Dict[str, List[int]] = {}
+        for i, text_hash in enumerate(text_hashes):
+            blocks_by_hash.setdefault(text_hash, []).append(i)
+
+        vectors = embed_cache.get_many(blocks_by_hash)
+        missing = {h: texts[idx[0]] for h, idx in blocks_by_hash.items() if h not in vectors}
+        print(f"嵌入缓存命中: {len(texts) - sum(len(blocks_by_hash[h]) for h in missing)}/{len(texts)}")
+
+        def resolved(hashes: List[str], hash_vectors: Dict[str, List[float]]):
+            ready = [(i, hash_vectors[h]) for h in hashes for i in blocks_by_hash[h]]
+            for start in range(0, len(ready), chunk_size):
+                chunk = ready[start:start + chunk_size]
+                yield [blocks[i] for i, _ in chunk], [v for _, v in chunk]
+
+        yield from resolved(list(vectors), vectors)
+
+        missing_hashes = list(missing)
+        missing_texts = list(missing.values())
+        batch_size = int(os.environ.get("EMBED_BATCH", 64))
+        max_workers = 4
+        batch_starts = iter(range(0, len(missing_texts), batch_size))
+        pending = set()
+
+        def submit_next():
+            start = next(batch_starts, None)
+            if start is not None:
+                pending.add(ex.submit(self._embed_batch, start, missing_texts[start:start + batch_size],
+                                      missing_hashes[start:start + batch_size]))
+
+        # openai 客户端线程安全，多个批次的网络请求并行发出；
+        # 同时在途的请求不超过 max_workers 个，完成一个再补发一个，避免结果在内存中堆积
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            try:
+                for _ in range(max_workers):
+                    submit_next()
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.discard(future)
+                        batch_embeddings, batch_hashes = future.result()
+                        new_vectors = dict(zip(batch_hashes, batch_embeddings))
+                        embed_cache.put_many(new_vectors)
+                        submit_next()
+                        yield from resolved(batch_hashes, new_vectors)
+            finally:
+                # 消费方提前结束（如写入向量库失败）：取消尚未发出的请求，
+                # 已发出的请求照常完成，结果写入缓存，下次索引时不必重新付费请求
+                for future in pending:
+                    future.cancel()
+                for future in pending:
+                    if future.cancelled():
+                        continue
+                    try:
+                        batch_embeddings, batch_hashes = future.result()
+                        embed_cache.put_many(dict(zip(batch_hashes, batch_embeddings)))
+                    except Exception as e:
+                        print(f"缓存已完成的嵌入结果失败: {e}")
+
+    def _embed_batch(self, start: int, texts: List[str], keys: List[str]) -> Tuple[List[List[float]], List[str]]:
+        """一次请求嵌入一个批次，返回 (embeddings, 成功的 keys)；失败时逐条重试以定位出错的文本"""
+        try:
+            response = self.embedding_client.embeddings.create(input=texts, model=self.embedding_model)
+            data = sorted(response.data, key=lambda d: d.index)
+            return [d.embedding for d in data], list(keys)
+        except Exception as e:
+            print(f"批量处理文本块 {start}-{start + len(texts) - 1} 时出错: {e}，逐条重试")
+
+        embeddings = []
+        valid_keys = []
+        for i, (text, key) in enumerate(zip(texts, keys), start):
+            try:
+                response = self.embedding_client.embeddings.create(input=[text], model=self.embedding_model)
+                embeddings.append(response.data[0].embedding)
+                valid_keys.append(key)
+            except Exception as e:
+                print(f"处理文本块 {i} 时出错: {e}")
+                print(f"文本长度: {len(text)}")
+                continue
+        return embeddings, valid_keys
 
     def _prepare_text_for_embedding(self, block: Dict) -> str:
         """准备用于嵌入的文本"""
@@ -1,95 +1,188 @@
 
 from pathlib import Path
 from fastmcp import FastMCP
-from hashlib import md5
 from openai import OpenAI
+import asyncio
+import httpx
+import importlib.util
 import os
 import threading
-import time
 import logging
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Set
 
-from .code_indexer import IncrementalCodeIndexer
+from .code_indexer import IncrementalCodeIndexer, _collection_name_for
 from .vector_db import VectorDBManager
+from .query_cache import SemanticQueryCache
 
 
 # persist_dir in user's home to centralize chromadb storage
 user_chroma_dir = str(Path.home() / ".chromadb")
 vdb = VectorDBManager(persist_dir=user_chroma_dir)
+# 所有 OpenAI 客户端共用一个连接池，保持长连接，避免每次嵌入请求重新握手；
+# 安装了 h2 时启用 HTTP/2
+http_client = httpx.Client(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+    timeout=30.0
+)
 embedding_client = OpenAI(
     api_key=os.environ.get("OPENAI_API_KEY",""), 
-    base_url=os.environ.get("OPENAI_BASE_URL","")
+    base_url=os.environ.get("OPENAI_BASE_URL",""),
+    http_client=http_client
 )
 indexer = IncrementalCodeIndexer(
     embedding_client=embedding_client,
     vector_db_manager=vdb
 )
+query_cache = SemanticQueryCache()
 
 
 mcp = FastMCP("Semantic Context MCP Server!")
 
+# 所有后台定时任务共用的事件循环，运行在单个守护线程中，首次使用时创建
+_scheduler_loop: Optional[asyncio.AbstractEventLoop] = None
+_scheduler_lock = threading.Lock()
+
+
+def _get_scheduler_loop() -> asyncio.AbstractEventLoop:
+    global _scheduler_loop
+    with _scheduler_lock:
+        if _scheduler_loop is None:
+            _scheduler_loop = asyncio.new_event_loop()
+            threading.Thread(target=_scheduler_loop.run_forever, daemon=True).start()
+    return _scheduler_loop
+
+
 # 定时任务管理器
 class BackgroundIndexer:
-    def __init__(self, indexer):
+    def __init__(self, indexer, interval: float = 300):
         self.indexer = indexer
+        self.interval = interval
         self.running = False
-        self.thread = None
         self.current_project = None
+        # 每个项目一个定时增量索引任务及其停止事件，共用同一个事件循环
+        self.tasks: Dict[str, Future] = {}
+        self._stop_events: Dict[str, asyncio.Event] = {}
+        # 各项目初始全量索引的状态，避免重复调用时重复全量索引（嵌入请求按量计费）
+        self._initial_in_progress: Set[str] = set()
+        self._initial_done: Set[str] = set()
+        self._lock = threading.Lock()
         
-    def start_auto_indexing(self, project_path: str):
-        """启动自动索引，包括初始化全量索引和定时增量索引"""
-        self.current_project = project_path
-        
-        # 在后台线程中执行初始化全量索引
-        init_thread = threading.Thread(
-            target=self._initial_full_index,
-            args=(project_path,),
-            daemon=True
-        )
-        init_thread.start()
-        
-        # 启动定时增量索引
-        if not self.running:
+    def start_auto_indexing(self, project_path: str) -> str:
+        """启动自动索引，包括初始化全量索引和定时增量索引
+
+        返回初始全量索引的状态：
+        - "started": 本次启动了全量索引
+        - "already_running": 该项目的全量索引正在进行
+        - "already_indexed": 该项目已完成过全量索引，后续由定时增量索引维护
+        """
+        # 预先计算集合名，索引器和 query 工具随后直接命中缓存
+        _collection_name_for(project_path)
+        with self._lock:
+            self.current_project = project_path
+            if project_path in self._initial_in_progress:
+                state = "already_running"
+            elif project_path in self._initial_done:
+                state = "already_indexed"
+            else:
+                self._initial_in_progress.add(project_path)
+                state = "started"
+
+            # 启动该项目的定时增量索引：作为协程挂到共享事件循环上，不再独占线程
+            if project_path not in self.tasks:
+                self.tasks[project_path] = asyncio.run_coroutine_threadsafe(
+                    self._periodic_incremental_index(project_path), _get_scheduler_loop()
+                )
             self.running = True
-            self.thread = threading.Thread(target=self._periodic_incremental_index, daemon=True)
-            self.thread.start()
+
+        if state == "started":
+            # 在后台线程中执行初始化全量索引
+            init_thread = threading.Thread(
+                target=self._initial_full_index,
+                args=(project_path,),
+                daemon=True
+            )
+            init_thread.start()
+        return state
     
     def _initial_full_index(self, project_path: str):
         """初始化全量索引"""
         try:
             logging.info(f"Starting initial full index for {project_path}")
             self.indexer.full_index(project_path)
+            query_cache.invalidate()
             logging.info(f"Initial full index completed for {project_path}")
+            # 只有成功完成才记为已索引；失败时下次调用 full_index 会重试
+            with self._lock:
+                self._initial_done.add(project_path)
         except Exception as e:
             logging.error(f"Error during initial full index: {e}")
+        finally:
+            with self._lock:
+                self._initial_in_progress.discard(project_path)
     
-    def _periodic_incremental_index(self):
-        """每5分钟执行一次增量索引"""
-        while self.running:
-            if self.current_project:
+    async def _periodic_incremental_index(self, project_path: str):
+        """每 interval 秒（默认5分钟）对一个项目执行一次增量索引，stop() 后立即退出等待"""
+        # Event 需在事件循环内创建
+        stop_event = asyncio.Event()
+        with self._lock:
+            self._stop_events[project_path] = stop_event
+        loop = asyncio.get_running_loop()
+        try:
+            while not stop_event.is_set():
                 try:
-                    logging.info("Running periodic incremental index...")
-                    self.indexer.run_incremental_indexing(self.current_project)
-                    logging.info("Periodic incremental index completed")
+                    logging.info(f"Running periodic incremental index for {project_path}...")
+                    # 索引是 CPU / 网络密集的同步代码，放到线程池中执行，不阻塞事件循环
+                    changes = await loop.run_in_executor(
+                        None, self.indexer.run_incremental_indexing, project_path
+                    )
+                    if changes['added'] or changes['modified'] or changes['deleted']:
+                        query_cache.invalidate()
+                    logging.info(f"Periodic incremental index completed for {project_path}")
                 except Exception as e:
                     logging.error(f"Error during periodic incremental index: {e}")
-            
-            # 等待5分钟
-            time.sleep(300)  # 300秒 = 5分钟
+
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                if self._stop_events.get(project_path) is stop_event:
+                    del self._stop_events[project_path]
     
-    def stop(self):
-        """停止定时任务"""
-        self.running = False
+    def stop(self, project_path: Optional[str] = None):
+        """停止定时任务；project_path 为 None 时停止所有项目"""
+        with self._lock:
+            targets = list(self.tasks) if project_path is None else [project_path]
+            for path in targets:
+                task = self.tasks.pop(path, None)
+                stop_event = self._stop_events.pop(path, None)
+                if stop_event is not None:
+                    _get_scheduler_loop().call_soon_threadsafe(stop_event.set)
+                elif task is not None:
+                    # 协程尚未开始运行，直接取消
+                    task.cancel()
+            self.running = bool(self.tasks)
 
 # 创建后台索引器实例
 background_indexer = BackgroundIndexer(indexer)
 
+_FULL_INDEX_MESSAGES = {
+    "started": "Full indexing started in background",
+    "already_running": "Full indexing is already running for this project",
+    "already_indexed": "Project already indexed; changes are picked up by periodic incremental indexing",
+}
+
 @mcp.tool()
 def full_index(project_path: str):
     try:
-        background_indexer.start_auto_indexing(project_path)
+        state = background_indexer.start_auto_indexing(project_path)
         return {
             "status": "ok",
-            "message": "Full indexing ensured (started in background if not present)"
+            "index_status": state,
+            "message": _FULL_INDEX_MESSAGES[state]
         }
     except Exception as e:
         return {"error": str(e)}
@@ -102,25 +195,69 @@ def status(project_path: str):
         return {"error": str(e)}
 
 @mcp.tool()
-def query(project_path: str, text: str, top_k: int = 5):
+def query(project_path: str, text: str = "", top_k: int = 5, texts: Optional[List[str]] = None):
+    """语义检索代码；传入 texts 时一次处理多个查询，按顺序返回结果列表"""
     try:
-        project_root = Path(project_path)
-        proj_name = project_root.name
-        proj_hash = md5(str(project_root.resolve()).encode()).hexdigest()[:8]
-        collection_name = f"{proj_name}-{proj_hash}"
+        collection_name = indexer._get_collection_name(project_path)
+
+        if texts is not None:
+            return _query_many(collection_name, texts, top_k)
+
+        cached = query_cache.get_exact(collection_name, text, top_k)
+        if cached is not None:
+            return cached
 
         emb = embedding_client.embeddings.create(
             input=[text],
             model=os.environ.get("OPENAI_MODEL_NAME", "")
         ).data[0].embedding
 
+        # 语义相近的查询直接复用缓存结果，跳过向量库查询
+        cached = query_cache.get_similar(collection_name, emb, top_k)
+        if cached is not None:
+            return cached
+
         res = vdb.query_by_embedding(
             collection_name=collection_name, embedding=emb, top_k=top_k
         )
+        if res:
+            query_cache.put(collection_name, text, top_k, emb, res)
         return res
     except Exception as e:
         return {"error": str(e)}
 
 
+def _query_many(collection_name: str, texts: List[str], top_k: int) -> List[Any]:
+    """批量查询：未命中缓存的文本合并为一次嵌入请求和一次向量库查询"""
+    results = [query_cache.get_exact(collection_name, t, top_k) for t in texts]
+    pending = [i for i, r in enumerate(results) if r is None]
+    if not pending:
+        return results
+
+    data = embedding_client.embeddings.create(
+        input=[texts[i] for i in pending],
+        model=os.environ.get("OPENAI_MODEL_NAME", "")
+    ).data
+    embs = [d.embedding for d in sorted(data, key=lambda d: d.index)]
+
+    to_query = []
+    for i, emb in zip(pending, embs):
+        cached = query_cache.get_similar(collection_name, emb, top_k)
+        if cached is not None:
+            results[i] = cached
+        else:
+            to_query.append((i, emb))
+
+    if to_query:
+        batch_res = vdb.query_by_embeddings_batch(
+            collection_name=collection_name, embeddings=[emb for _, emb in to_query], top_k=top_k
+        )
+        for (i, emb), res in zip(to_query, batch_res):
+            results[i] = res
+            if res:
+                query_cache.put(collection_name, texts[i], top_k, emb, res)
+    return results
+
+
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
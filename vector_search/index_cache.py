@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .ast_parser import PARSER_VERSION
+from .code_change_tracker import CodeChangeTracker
+
+
+def _quantize_int8_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """按行批量做对称 int8 量化，返回 (codes, 每行的缩放系数)；全零行的缩放系数记为 1"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127 if matrix.shape[1] else np.zeros(len(matrix), dtype=np.float32)
+    scales[scales == 0] = 1.0
+    codes = np.round(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def _dequantize_int8(codes: np.ndarray, scale: float) -> np.ndarray:
+    return codes.astype(np.float32) * scale
+
+
+def _connect(cache_file) -> sqlite3.Connection:
+    """打开缓存数据库：WAL 模式允许读写并发，多个索引任务同时写入时等待而不是立即报错"""
+    conn = sqlite3.connect(str(cache_file), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class BlockCache:
+    """代码块缓存：以 (文件相对路径, 文件内容哈希) 为键缓存 AST 解析结果
+
+    存储在 .code_index/block_cache.sqlite，每个文件只保留最新的一份解析结果，
+    文件内容和解析器版本（PARSER_VERSION）都不变时跳过重新解析。
+    """
+
+    def __init__(self, project_root: str, index_dir: str = ".code_index",
+                 parser_version: int = PARSER_VERSION):
+        cache_file = CodeChangeTracker._get_index_dir(project_root, index_dir) / "block_cache.sqlite"
+        self.parser_version = parser_version
+        self.conn = _connect(cache_file)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(blocks)")}
+        if columns and 'parser_version' not in columns:
+            # 旧表没有解析器版本，其中的结果无法判断是否过期，直接丢弃
+            self.conn.execute("DROP TABLE blocks")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "file_path TEXT PRIMARY KEY, file_hash TEXT NOT NULL, "
+            "parser_version INTEGER NOT NULL, blocks TEXT NOT NULL)"
+        )
+
+    def __enter__(self) -> 'BlockCache':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get(self, file_path: str, file_hash: str, abs_path: Path) -> Optional[List[Dict]]:
+        """命中时返回缓存的代码块，文件哈希或解析器版本不一致视为未命中
+
+        缓存中不保存绝对路径（项目目录可能被移动），命中后按 abs_path 还原 file_path 和 id。
+        """
+        row = self.conn.execute(
+            "SELECT blocks FROM blocks WHERE file_path = ? AND file_hash = ? AND parser_version = ?",
+            (file_path, file_hash, self.parser_version)
+        ).fetchone()
+        if not row:
+            return None
+        blocks = json.loads(row[0])
+        return [self._restore_paths(b, abs_path) for b in blocks]
+
+    def put(self, file_path: str, file_hash: str, blocks: List[Dict], abs_path: Path):
+        """写入（覆盖）某个文件的解析结果"""
+        stored = [self._strip_paths(b, abs_path) for b in blocks]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO blocks (file_path, file_hash, parser_version, blocks) VALUES (?, ?, ?, ?)",
+            (file_path, file_hash, self.parser_version, json.dumps(stored, ensure_ascii=False))
+        )
+        # 每次写入后立即提交，不长时间持有写锁
+        self.conn.commit()
+
+    @staticmethod
+    def _strip_paths(block: Dict, abs_path: Path) -> Dict:
+        """去掉代码块中的绝对路径：id 只保留路径之后的部分，并记录路径的写法"""
+        stored = {k: v for k, v in block.items() if k != 'file_path'}
+        block_id = block.get('id', '')
+        stored['id_path'] = None
+        for style, prefix in (('posix', abs_path.as_posix()), ('native', str(abs_path))):
+            if block_id.startswith(prefix + ':'):
+                stored['id'] = block_id[len(prefix):]
+                stored['id_path'] = style
+                break
+        return stored
+
+    @staticmethod
+    def _restore_paths(stored: Dict, abs_path: Path) -> Dict:
+        block = dict(stored)
+        style = block.pop('id_path')
+        if style == 'posix':
+            block['id'] = abs_path.as_posix() + block['id']
+        elif style == 'native':
+            block['id'] = str(abs_path) + block['id']
+        block['file_path'] = str(abs_path)
+        return block
+
+    def remove(self, file_paths: List[str]):
+        """移除已删除文件的缓存"""
+        self.conn.executemany("DELETE FROM blocks WHERE file_path = ?", [(p,) for p in file_paths])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class EmbeddingCache:
+    """嵌入向量缓存：以 (模型, 文本内容) 的哈希为键，避免重复文本反复调用嵌入接口
+
+    存储在 .code_index/embed_cache.sqlite，保存精度由 EMBED_QUANT 决定：
+    - 默认 float16，体积为 float32 的一半
+    - EMBED_QUANT=int8：int8 + 每向量一个缩放系数，体积约为 float32 的 1/4
+    - EMBED_QUANT=fp32：float32，无损
+    命中缓存的向量按保存精度还原后写入 Chroma，因此 float16 / int8 下，
+    缓存命中的代码块在向量库中的向量与直接请求接口得到的向量略有差异；需要完全一致时使用 fp32。
+    读取时各种格式都支持（dtype 列为 NULL 的旧数据：scale 为 NULL 表示 float16，否则为 int8）。
+    """
+
+    def __init__(self, project_root: str, index_dir: str = ".code_index"):
+        cache_file = CodeChangeTracker._get_index_dir(project_root, index_dir) / "embed_cache.sqlite"
+        quant = os.environ.get("EMBED_QUANT", "").lower()
+        if quant == "int8":
+            self.dtype = "int8"
+        elif quant in ("fp32", "float32", "none", "off"):
+            self.dtype = "float32"
+        else:
+            self.dtype = "float16"
+        self.conn = _connect(cache_file)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "text_hash TEXT PRIMARY KEY, vector BLOB NOT NULL, scale REAL, dtype TEXT)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")}
+        if 'dtype' not in columns:
+            self.conn.execute("ALTER TABLE embeddings ADD COLUMN dtype TEXT")
+
+    def __enter__(self) -> 'EmbeddingCache':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @staticmethod
+    def text_hash(model: str, text: str) -> str:
+        """计算缓存键，模型不同的向量互不复用"""
+        return blake2b(f"{model}\0{text}".encode(), digest_size=16).hexdigest()
+
+    def get_many(self, text_hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """批量查询，只返回命中的条目"""
+        text_hashes = list(text_hashes)
+        found = {}
+        # SQLite 单条语句的参数个数有限制，分段查询
+        for start in range(0, len(text_hashes), 500):
+            chunk = text_hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT text_hash, vector, scale, dtype FROM embeddings WHERE text_hash IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for text_hash, vector, scale, dtype in rows:
+                if dtype is None:
+                    dtype = "float16" if scale is None else "int8"
+                if dtype == "int8":
+                    v = _dequantize_int8(np.frombuffer(vector, dtype=np.int8), scale)
+                else:
+                    v = np.frombuffer(vector, dtype=dtype).astype(np.float32)
+                found[text_hash] = v.tolist()
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        """批量写入新生成的向量"""
+        if not vectors:
+            return
+        # 同一模型的向量维度一致，整体转成矩阵一次完成量化
+        matrix = np.asarray(list(vectors.values()), dtype=np.float32)
+        if self.dtype == "int8":
+            codes, scales = _quantize_int8_rows(matrix)
+            rows = [(h, c.tobytes(), float(sc), self.dtype) for h, c, sc in zip(vectors, codes, scales)]
+        else:
+            stored = matrix.astype(self.dtype, copy=False)
+            rows = [(h, v.tobytes(), None, self.dtype) for h, v in zip(vectors, stored)]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (text_hash, vector, scale, dtype) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        # 每个批次写完即提交，嵌入请求进行期间不持有写锁
+        self.conn.commit()
+
+    def prune(self, keep_hashes: Iterable[str]) -> int:
+        """删除 keep_hashes 之外的所有条目（全量索引后调用，清理不再被任何代码块引用的向量），返回删除条数"""
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_hashes (text_hash TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM keep_hashes")
+        self.conn.executemany("INSERT OR IGNORE INTO keep_hashes VALUES (?)", ((h,) for h in keep_hashes))
+        removed = self.conn.execute(
+            "DELETE FROM embeddings WHERE text_hash NOT IN (SELECT text_hash FROM keep_hashes)"
+        ).rowcount
+        self.conn.execute("DROP TABLE keep_hashes")
+        self.conn.commit()
+        return removed
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,166 @@
+import threading
+import time
+from hashlib import md5
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class _CollectionEntries:
+    """单个集合的缓存条目，embedding 矩阵的每一行与各列表下标一一对应
+
+    向量和数值列保存在按容量倍增的连续 float32 缓冲区中，追加为均摊 O(1)，
+    查找时对有效行做一次矩阵-向量乘法。
+    """
+
+    def __init__(self, dim: int, capacity: int = 16):
+        self._vectors = np.empty((capacity, dim), dtype=np.float32)
+        self._expires = np.empty(capacity, dtype=np.float64)
+        self._last_used = np.empty(capacity, dtype=np.float64)
+        self._top_ks = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+        self.keys: List[Tuple[str, int]] = []
+        self.results: List[Any] = []
+        self.index: Dict[Tuple[str, int], int] = {}
+
+    @property
+    def dim(self) -> int:
+        return self._vectors.shape[1]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._vectors[:self.size]
+
+    @property
+    def expires(self) -> np.ndarray:
+        return self._expires[:self.size]
+
+    @property
+    def last_used(self) -> np.ndarray:
+        return self._last_used[:self.size]
+
+    @property
+    def top_ks(self) -> np.ndarray:
+        return self._top_ks[:self.size]
+
+    def _grow(self):
+        capacity = max(1, 2 * len(self._vectors))
+        for name in ('_vectors', '_expires', '_last_used', '_top_ks'):
+            old = getattr(self, name)
+            buf = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            buf[:self.size] = old[:self.size]
+            setattr(self, name, buf)
+
+    def append(self, key: Tuple[str, int], embedding: np.ndarray, result: Any, expires: float, now: float):
+        if self.size == len(self._vectors):
+            self._grow()
+        row = self.size
+        self._vectors[row] = embedding
+        self._expires[row] = expires
+        self._last_used[row] = now
+        self._top_ks[row] = key[1]
+        self.size += 1
+        self.keys.append(key)
+        self.results.append(result)
+        self.index[key] = row
+
+    def remove(self, rows: List[int]):
+        if not rows:
+            return
+        drop = set(rows)
+        keep = [i for i in range(self.size) if i not in drop]
+        # 保留的行整体前移，缓冲区容量不变
+        for name in ('_vectors', '_expires', '_last_used', '_top_ks'):
+            buf = getattr(self, name)
+            buf[:len(keep)] = buf[keep]
+        self.size = len(keep)
+        self.keys = [self.keys[i] for i in keep]
+        self.results = [self.results[i] for i in keep]
+        self.index = {k: i for i, k in enumerate(self.keys)}
+
+
+class SemanticQueryCache:
+    """query 工具的进程内语义缓存
+
+    两级查找：
+    1. (集合, 文本哈希, top_k) 精确命中，无需请求嵌入接口
+    2. 查询向量与已缓存查询的余弦相似度超过阈值，且 top_k 相同，跳过向量库查询
+
+    每个集合最多保留 max_entries 条（按最近使用淘汰），条目超过 ttl 秒后失效。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._collections: Dict[str, _CollectionEntries] = {}
+
+    @staticmethod
+    def _key(text: str, top_k: int) -> Tuple[str, int]:
+        return md5(text.encode()).hexdigest(), top_k
+
+    def get_exact(self, collection_name: str, text: str, top_k: int) -> Optional[Any]:
+        """按查询文本精确命中"""
+        now = time.time()
+        with self._lock:
+            entries = self._collections.get(collection_name)
+            if entries is None:
+                return None
+            row = entries.index.get(self._key(text, top_k))
+            if row is None:
+                return None
+            if entries.expires[row] <= now:
+                entries.remove([row])
+                return None
+            entries.last_used[row] = now
+            return entries.results[row]
+
+    def get_similar(self, collection_name: str, embedding: List[float], top_k: int) -> Optional[Any]:
+        """按查询向量的余弦相似度命中"""
+        now = time.time()
+        q = self._normalize(embedding)
+        with self._lock:
+            entries = self._collections.get(collection_name)
+            if entries is None or not entries.size or entries.dim != q.shape[0]:
+                return None
+            sims = entries.matrix @ q
+            sims[(entries.top_ks != top_k) | (entries.expires <= now)] = -np.inf
+            row = int(np.argmax(sims))
+            if sims[row] < self.threshold:
+                return None
+            entries.last_used[row] = now
+            return entries.results[row]
+
+    def put(self, collection_name: str, text: str, top_k: int, embedding: List[float], result: Any):
+        """缓存一次查询结果"""
+        now = time.time()
+        q = self._normalize(embedding)
+        key = self._key(text, top_k)
+        with self._lock:
+            entries = self._collections.get(collection_name)
+            if entries is None or entries.dim != q.shape[0]:
+                # 首次写入，或嵌入模型维度变化时重建
+                entries = self._collections[collection_name] = _CollectionEntries(q.shape[0])
+
+            stale = np.flatnonzero(entries.expires <= now).tolist()
+            if key in entries.index:
+                stale.append(entries.index[key])
+            entries.remove(stale)
+            if entries.size >= self.max_entries:
+                entries.remove([int(np.argmin(entries.last_used))])
+            entries.append(key, q, result, now + self.ttl, now)
+
+    def invalidate(self, collection_name: Optional[str] = None):
+        """索引更新后清空缓存；collection_name 为 None 时清空所有集合"""
+        with self._lock:
+            if collection_name is None:
+                self._collections.clear()
+            else:
+                self._collections.pop(collection_name, None)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        v = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
@@ -1,9 +1,101 @@
+import itertools
 import os
 import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 
 import chromadb
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖，没有安装时退回标准库 json
+    orjson = None
+
+try:
+    from chromadb.errors import ChromaError
+    # 集合不存在等错误：新版本抛出 ChromaError 子类，0.4 及更早版本抛出 ValueError
+    _CHROMA_ERRORS: Tuple[type, ...] = (ChromaError, ValueError)
+except ImportError:
+    _CHROMA_ERRORS = (ValueError,)
+
+# 所有 VectorDBManager 共用的写入线程池，跨索引任务复用
+_UPSERT_WORKERS = 4
+_upsert_pool = ThreadPoolExecutor(max_workers=_UPSERT_WORKERS)
+
+_MAX_CACHED_COLLECTIONS = 32
+# 写入 Chroma 的代码文本最大长度
+_MAX_DOCUMENT_CHARS = 10000
+_PER_QUERY_FIELDS = ('ids', 'distances', 'metadatas', 'documents', 'embeddings', 'uris', 'data')
+
+
+def _sanitize_value(v: Any) -> Optional[Any]:
+    # Allowed scalar types: str, int, float, bool, None
+    if v is None:
+        return None
+    # 常见的精确类型用 is 比较，比 isinstance 遍历元组更快；子类（如 numpy 标量）再走 isinstance
+    t = type(v)
+    if t is str or t is int or t is float or t is bool:
+        return v
+    if isinstance(v, (str, int, float, bool)):
+        return v
+    # For lists/dicts/other objects, JSON-encode to keep metadata information
+    if orjson is not None:
+        try:
+            return orjson.dumps(v, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            pass
+    try:
+        return json.dumps(v, ensure_ascii=False)
+    except (TypeError, ValueError):
+        # Fallback to string representation
+        return str(v)
+
+
+def _sanitize_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: _sanitize_value(v) for k, v in meta.items()}
+
+
+def _truncate_document(code: str, limit: int = _MAX_DOCUMENT_CHARS) -> str:
+    """截断过长的代码文本，尽量在行边界处截断，避免保存半行代码
+
+    只在窗口后半段内找换行；前半段没有可用换行（如超长单行）时直接按 limit 截断，避免丢掉大半内容。
+    """
+    cut = code.rfind('\n', limit // 2, limit + 1)
+    return code[:cut] if cut > 0 else code[:limit]
+
+
+def _chroma_version() -> Tuple[int, ...]:
+    """已安装 chromadb 的版本号，无法解析时视为最新版本"""
+    parts = []
+    for part in getattr(chromadb, '__version__', '').split('.')[:3]:
+        digits = ''.join(itertools.takewhile(str.isdigit, part))
+        if not digits:
+            break
+        parts.append(int(digits))
+    return tuple(parts) or (float('inf'),)
+
+
+# 0.6 起 Chroma 内部以 ndarray 处理 embeddings；更早的版本要么只接受 list，
+# 要么（0.5.x）收到 ndarray 后又 .tolist() 转回 list，转换成矩阵反而多做一次往返
+_ACCEPTS_NDARRAY_EMBEDDINGS = _chroma_version() >= (0, 6)
+
+
+def _chroma_embeddings(embeddings: List[List[float]]):
+    """按已安装的 Chroma 版本准备 embeddings：新版本转为连续的 float32 矩阵，旧版本原样传入 list"""
+    return np.asarray(embeddings, dtype=np.float32) if _ACCEPTS_NDARRAY_EMBEDDINGS else embeddings
+
+
+class _UpsertQueue(queue.Queue):
+    """写入队列，附带写入线程遇到的第一个异常"""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.error: Optional[BaseException] = None
 
 
 class VectorDBManager:
@@ -29,72 +121,215 @@ class VectorDBManager:
             # Save To Memory
             self.client = chromadb.Client()
 
-    @staticmethod
-    def _sanitize_value(v: Any) -> Optional[Any]:
-        # Allowed scalar types: str, int, float, bool, None
-        if v is None:
-            return None
-        if isinstance(v, (str, int, float, bool)):
-            return v
-        # For lists/dicts/other objects, JSON-encode to keep metadata information
-        try:
-            return json.dumps(v, ensure_ascii=False)
-        except Exception:
-            # Fallback to string representation
-            return str(v)
+        # Chroma >= 0.4 自动持久化，persist() 已无意义；旧版本只在 flush() 中统一持久化一次
+        self._needs_persist = _chroma_version() < (0, 4) and hasattr(self.client, 'persist')
 
-    def _sanitize_metadata(self, meta: Dict[str, Any]) -> Dict[str, Any]:
-        return {k: self._sanitize_value(v) for k, v in meta.items()}
+        self._collections: "OrderedDict[str, Any]" = OrderedDict()
+        self._collections_lock = threading.Lock()
 
-    def upsert_blocks(self, collection_name: str, blocks: List[Dict], embeddings: List[List[float]]):
-        try:
+    def _get_collection(self, collection_name: str, create: bool = False):
+        """获取集合句柄并缓存（最近使用的 _MAX_CACHED_COLLECTIONS 个）；create 为 True 时不存在则创建"""
+        with self._collections_lock:
+            collection = self._collections.get(collection_name)
+            if collection is not None:
+                self._collections.move_to_end(collection_name)
+                return collection
+
+        if create:
+            collection = self.client.get_or_create_collection(name=collection_name)
+        else:
             collection = self.client.get_collection(name=collection_name)
-        except Exception:
-            collection = self.client.create_collection(name=collection_name)
 
-        ids = [b['id'] for b in blocks]
-        raw_metadatas = [{
-            'type': b.get('type'),
-            'name': b.get('name'),
-            'file_path': b.get('file_path'),
-            'line_number': b.get('line_number'),
-            'signature': b.get('signature'),
-            'last_updated': datetime.now().isoformat()
-        } for b in blocks]
+        with self._collections_lock:
+            self._collections[collection_name] = collection
+            self._collections.move_to_end(collection_name)
+            while len(self._collections) > _MAX_CACHED_COLLECTIONS:
+                self._collections.popitem(last=False)
+        return collection
 
-        metadatas = [self._sanitize_metadata(m) for m in raw_metadatas]
-        documents = [b.get('code', '')[:10000] for b in blocks]
+    def resolve_collection_name(self, collection_name: str, legacy_name: str) -> str:
+        """优先使用 collection_name；它不存在而 legacy_name 对应的集合存在时返回 legacy_name"""
+        for name in (collection_name, legacy_name):
+            try:
+                self._get_collection(name)
+                return name
+            except _CHROMA_ERRORS:
+                continue
+        return collection_name
 
+    def flush(self):
+        """在一次索引结束时调用，旧版 Chroma 需要显式持久化"""
+        if not self._needs_persist:
+            return
         try:
-            collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+            self.client.persist()
         except Exception:
-            # fallback for older clients
-            collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+            pass
+
+    def _forget_collection(self, collection_name: str):
+        with self._collections_lock:
+            self._collections.pop(collection_name, None)
+
+    _sanitize_value = staticmethod(_sanitize_value)
+    _sanitize_metadata = staticmethod(_sanitize_metadata)
 
+    def upsert_blocks(self, collection_name: str, blocks: List[Dict], embeddings: List[List[float]],
+                      batch_size: int = 256):
+        """写入代码块及其向量
+
+        Chroma 0.6 及以上版本的 embeddings 转为连续的 float32 矩阵再传入，避免其逐个解包 Python float
+        （调用方若已持有 float32 的 ndarray，不会产生额外拷贝）；更早的版本原样传入 list。
+        不会逐次持久化，一次索引结束后调用 flush()。
+        """
+        collection = self._get_collection(collection_name, create=True)
+        write = self._upsert_fn(collection)
+        embeddings = _chroma_embeddings(embeddings)
+
+        # 分批写入，避免一次性构造并提交整个索引的超大请求；各批次并行提交以重叠网络 I/O
+        futures = [
+            _upsert_pool.submit(
+                self._upsert_batch, write,
+                blocks[start:start + batch_size], embeddings[start:start + batch_size]
+            )
+            for start in range(0, len(blocks), batch_size)
+        ]
         try:
-            if hasattr(self.client, 'persist'):
-                self.client.persist()
+            for future in as_completed(futures):
+                future.result()
         except Exception:
-            pass
+            # 集合可能已被删除或重建，下次重新获取
+            self._forget_collection(collection_name)
+            raise
+
+    def _upsert_batch(self, write, blocks: List[Dict], embeddings):
+        ids, metadatas, documents = self._build_upsert_columns(blocks)
+        write(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    @staticmethod
+    def _build_upsert_columns(blocks: List[Dict]) -> Tuple[List[str], List[Dict], List[str]]:
+        # 单次遍历按列构造 ids / metadatas / documents；
+        # 解析器产生的字段通常已是 str / int / None，经 _sanitize_value 的快速路径直接返回，
+        # 其他类型（列表、字典等）才会被编码为 JSON 字符串
+        now_iso = datetime.now().isoformat()
+        n = len(blocks)
+        ids = [None] * n
+        metadatas = [None] * n
+        documents = [None] * n
+        for i, b in enumerate(blocks):
+            ids[i] = b['id']
+            metadatas[i] = {
+                'type': _sanitize_value(b.get('type')),
+                'name': _sanitize_value(b.get('name')),
+                'file_path': _sanitize_value(b.get('file_path')),
+                'line_number': _sanitize_value(b.get('line_number')),
+                'signature': _sanitize_value(b.get('signature')),
+                'last_updated': now_iso
+            }
+            code = b.get('code', '')
+            documents[i] = code if len(code) <= _MAX_DOCUMENT_CHARS else _truncate_document(code)
+        return ids, metadatas, documents
+
+    @staticmethod
+    def _upsert_fn(collection):
+        """每个集合只确定一次写入方法：旧版客户端没有 upsert 时退回 add"""
+        return getattr(collection, 'upsert', None) or collection.add
+
+    def start_upsert_worker(self, collection_name: str, queue_size: int = 4) -> Tuple['_UpsertQueue', threading.Thread]:
+        """启动后台写入线程，返回 (队列, 线程)
+
+        通过 upsert_blocks_streaming 向队列推送批次，队列满时推送方阻塞（背压）；
+        全部推送完后调用 finish_upsert_worker 结束并等待写入完成。
+        """
+        q = _UpsertQueue(maxsize=queue_size)
+        worker = threading.Thread(target=self._upsert_worker, args=(collection_name, q), daemon=True)
+        worker.start()
+        return q, worker
+
+    def _upsert_worker(self, collection_name: str, q: '_UpsertQueue'):
+        # 从队列取出批次后提交到共享写入线程池并行写入；信号量限制同时在写的批次数，
+        # 线程池满时不再从队列取数，队列满后推送方阻塞，背压得以保留
+        write = None
+        in_flight = threading.BoundedSemaphore(_UPSERT_WORKERS)
+        futures = []
+
+        def on_done(future):
+            in_flight.release()
+            error = future.exception()
+            if error is not None and q.error is None:
+                q.error = error
+                self._forget_collection(collection_name)
+
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if q.error is not None:
+                # 已出错：继续取出剩余批次，避免推送方阻塞
+                continue
+            try:
+                if write is None:
+                    write = self._upsert_fn(self._get_collection(collection_name, create=True))
+            except Exception as e:
+                q.error = e
+                self._forget_collection(collection_name)
+                continue
+            ids, embeddings, metadatas, documents = item
+            in_flight.acquire()
+            future = _upsert_pool.submit(
+                write, ids=ids, embeddings=embeddings,
+                metadatas=metadatas, documents=documents
+            )
+            future.add_done_callback(on_done)
+            futures.append(future)
+        wait(futures)
+
+    def upsert_blocks_streaming(self, q: '_UpsertQueue', blocks: List[Dict], embeddings: List[List[float]]):
+        """把一个批次推送给写入线程；写入线程已出错时直接抛出该异常"""
+        if q.error is not None:
+            raise q.error
+        ids, metadatas, documents = self._build_upsert_columns(blocks)
+        q.put((ids, _chroma_embeddings(embeddings), metadatas, documents))
+
+    def finish_upsert_worker(self, q: '_UpsertQueue', worker: threading.Thread):
+        """通知写入线程结束并等待剩余批次写完，写入出错时抛出异常"""
+        q.put(None)
+        worker.join()
+        if q.error is not None:
+            raise q.error
 
     def delete_blocks_by_file(self, collection_name: str, file_path: str):
         try:
-            collection = self.client.get_collection(name=collection_name)
+            collection = self._get_collection(collection_name)
             collection.delete(where={"file_path": file_path})
-        except Exception:
-            pass
+        except _CHROMA_ERRORS:
+            self._forget_collection(collection_name)
         return
    
     def get_block_by_id(self, collection_name: str, block_id: str) -> Dict:
         try:
-            collection = self.client.get_collection(name=collection_name)
+            collection = self._get_collection(collection_name)
             return collection.get(ids=[block_id])
-        except Exception:
+        except _CHROMA_ERRORS:
+            self._forget_collection(collection_name)
             return {}
 
     def query_by_embedding(self, collection_name: str, embedding: List[float], top_k: int = 5) -> Dict:
         try:
-            collection = self.client.get_collection(name=collection_name)
+            collection = self._get_collection(collection_name)
             return collection.query(query_embeddings=[embedding], n_results=top_k, include=['metadatas', 'documents', 'distances'])
-        except Exception:
-            return {}
\ No newline at end of file
+        except _CHROMA_ERRORS:
+            self._forget_collection(collection_name)
+            return {}
+    def query_by_embeddings_batch(self, collection_name: str, embeddings: List[List[float]], top_k: int = 5) -> List[Dict]:
+        """一次向量库查询多个向量，按输入顺序返回每个查询的结果（结构与 query_by_embedding 相同）"""
+        try:
+            collection = self._get_collection(collection_name)
+            res = collection.query(query_embeddings=embeddings, n_results=top_k, include=['metadatas', 'documents', 'distances'])
+        except _CHROMA_ERRORS:
+            self._forget_collection(collection_name)
+            return [{} for _ in embeddings]
+        # 按查询拆分的字段是「每个查询一项」的列表，其余字段（如 included）原样保留
+        return [
+            {k: [v[i]] if k in _PER_QUERY_FIELDS and v is not None else v for k, v in res.items()}
+            for i in range(len(embeddings))
+        ]